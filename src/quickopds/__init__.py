@@ -1,24 +1,39 @@
 import argparse
+import json
+import multiprocessing
 import os
-import xml.etree.ElementTree as ET
+import re
 
+from dataclasses import dataclass, field
 from datetime import datetime, UTC
-from html.parser import HTMLParser
+from functools import lru_cache
+from html import unescape
 from importlib import resources
 from lxml import etree
 from pathlib import Path
 from pypdf import PdfReader
+from pypdf.errors import DependencyError, PyPdfError
 from urllib.parse import quote, urlparse
 from zipfile import ZipFile
 
 # Filename constants
 FEED_FILENAME = "index.xml"
 STYLE_FILENAME = "style.xsl"
+CACHE_FILENAME = ".quickopds-cache.json"
 
-# Constants for use in the dict we build up, for conversion to xml
-NAME = "NAME"
+# Seconds to wait for metadata from a single file before giving up on it
+METADATA_TIMEOUT = 5
+
+# Key in FORMATS holding the text to go inside each opds link
 CHILDREN = "CHILDREN"
-NAMESPACE = "NAMESPACE"
+
+# Namespaces for the feed, with atom as the default
+NSMAP = {
+    None: "http://www.w3.org/2005/Atom",
+    "opds": "http://opds-spec.org/2010/catalog",
+    "dcterms": "http://purl.org/dc/terms/",
+}
+ATOM = "{%s}" % NSMAP[None]
 
 # URIs for the opds links
 ACQUISITION = "http://opds-spec.org/acquisition"
@@ -100,20 +115,29 @@ FORMATS[".htm"] = FORMATS[".html"]
 FORMATS[".jpeg"] = FORMATS[".jpg"]
 FORMATS[""] = {"type": "unknown"}
 
+# The xml attributes and text of the opds link for each format, split out ahead of time
+LINK_ATTRIBUTES = {
+    ending: {k: v for k, v in attributes.items() if k != CHILDREN}
+    for ending, attributes in FORMATS.items()
+}
+LINK_TEXT = {
+    ending: attributes[CHILDREN][0]
+    for ending, attributes in FORMATS.items()
+    if CHILDREN in attributes
+}
 
-def dict_to_xml(d: dict) -> etree.Element:
-    """Convert the dict we built up into the final xml document."""
-    nsmap = d[NAMESPACE] if NAMESPACE in d else {}
-    attribs = {k: str(v) for k, v in d.items() if k not in [NAME, CHILDREN, NAMESPACE]}
-    element = etree.Element(d[NAME], attrib=attribs, nsmap=nsmap)
-    if CHILDREN in d:
-        for child in d[CHILDREN]:
-            if type(child) is dict:
-                element.append(dict_to_xml(child))
-            else:
-                assert type(child) is str
-                element.text = child
-    return element
+# Formats we can read book metadata from, most reliable first
+METADATA_ENDINGS = [".epub", ".kepub.epub", "_advanced.epub", ".pdf", "_cropped.pdf"]
+
+# Pattern matching the longest known ending of a filename, built from FORMATS
+FORMAT_ENDING = re.compile(
+    "(%s)$" % "|".join(re.escape(e) for e in sorted(FORMATS, key=len, reverse=True) if e),
+    re.IGNORECASE,
+)
+
+# Patterns for spotting html in descriptions and stripping its tags
+HTML_MARKUP = re.compile(r"<|&lt;|&amp;")
+HTML_TAG = re.compile(r"</?[A-Za-z][^>]*>|<!--.*?-->", re.DOTALL)
 
 
 def force_trailing_slash(path: str):
@@ -122,12 +146,18 @@ def force_trailing_slash(path: str):
     return path
 
 
-def text_item(name, text):
-    """Make an xml entity with text contents and no attributes."""
-    return {
-        NAME: name,
-        CHILDREN: [text],
-    }
+def text_item(name, text, **attribs):
+    """Make an atom xml element with text contents."""
+    element = etree.Element(ATOM + name, attribs)
+    element.text = text
+    return element
+
+
+def author_item(name):
+    """Make an atom xml author element with the given name."""
+    element = etree.Element(ATOM + "author")
+    element.append(text_item("name", name))
+    return element
 
 
 def timestamp_now():
@@ -140,39 +170,69 @@ def timestamp_now():
     )
 
 
-def timestamp(f):
-    """Get the UTC ISO-8601 timestamp for the given path's last update time."""
+def timestamp(mtime_ns: int):
+    """Get the UTC ISO-8601 timestamp for the given modification time in nanoseconds since the epoch."""
+    # Round to the nearest microsecond with integers, since a float can't hold this many nanoseconds exactly
+    seconds, microseconds = divmod((mtime_ns + 500) // 1000, 10**6)
     return (
-        datetime.fromtimestamp(f.stat().st_mtime, UTC)
+        datetime.fromtimestamp(seconds, UTC)
+        .replace(microsecond=microseconds)
         .isoformat()
         .replace("+00:00", "Z")
     )
 
 
-class HTMLFilter(HTMLParser):
-    text = ""
-
-    def handle_data(self, data):
-        self.text += data
+def get_ending(name):
+    """Get the key in FORMATS that matches the end of the given filename, or "" if none does."""
+    match = FORMAT_ENDING.search(name)
+    return match.group(1).lower() if match else ""
 
 
 def filter_html(text):
     """Given a string, attempt to sensibly remove html formatting and return plain text."""
-    if "<" in text or "&lt;" in text:
-        f = HTMLFilter()
-        f.feed(text)
-        return f.text
+    if text and HTML_MARKUP.search(text):
+        return unescape(HTML_TAG.sub("", text))
     return text
 
 
+def looks_like_pdf(path):
+    """Check cheaply whether the file at the given filepath has a pdf header and trailer."""
+    with open(path, "rb") as f:
+        head = f.read(1024)
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(size - 1024, 0))
+        tail = f.read()
+    return b"%PDF-" in head and b"startxref" in tail and b"%%EOF" in tail
+
+
 def get_pdf_metadata(path):
-    """Get appropriate metadata from the pdf at the given filepath."""
-    reader = PdfReader(path)
-    info = reader.metadata
+    """Get appropriate metadata from the pdf at the given filepath.
+
+    Only the trailer and the document info object it refers to are resolved, so
+    the page tree is never built.  Files that are broken, or that need a
+    password to open, are skipped.
+    """
+    if not looks_like_pdf(path):
+        print("Skipped metadata from broken pdf", path.name)
+        return dict()
+
+    try:
+        reader = PdfReader(path, strict=False)
+        if reader.is_encrypted and not reader.decrypt(""):
+            print("Skipped metadata from encrypted pdf", path.name)
+            return dict()
+        info = reader.trailer.get("/Info")
+        if info is not None:
+            info = info.get_object()
+    except (PyPdfError, DependencyError):
+        print("Skipped metadata from broken pdf", path.name)
+        return dict()
 
     meta = dict()
+    if info is None:
+        return meta
     for key, tag in [("/Author", "author"), ("/Title", "title")]:
-        if key in info.keys():
+        if key in info:
             meta[tag] = str(info[key])
 
     return meta
@@ -182,139 +242,242 @@ def get_epub_metadata(path):
     """Get appropriate metadata from the epub at the given filepath."""
     meta = dict()
 
+    # OPF uses namespaces, so define them
+    NS = {
+        "container": "urn:oasis:names:tc:opendocument:xmlns:container",
+        "dc": "http://purl.org/dc/elements/1.1/",
+        "opf": "http://www.idpf.org/2007/opf",
+    }
+
+    # The metadata we want, keyed by the qualified tag it appears under
+    tags = {
+        f"{{{NS['dc']}}}title": "title",
+        f"{{{NS['dc']}}}creator": "author",
+        f"{{{NS['dc']}}}description": "content",
+    }
+    end_of_metadata = f"{{{NS['opf']}}}metadata"
+
     with ZipFile(path, "r") as z:
         # Find the opf path
-        container = ET.fromstring(z.read("META-INF/container.xml"))
-        rootfile = container.find(
-            ".//{urn:oasis:names:tc:opendocument:xmlns:container}rootfile"
-        )
+        with z.open("META-INF/container.xml") as f:
+            container = etree.parse(f)
+        rootfile = container.find(".//container:rootfile", namespaces=NS)
         opf_path = rootfile.get("full-path")
 
-        # Parse the opf file
-        opf = ET.fromstring(z.read(opf_path))
+        # Stream through the opf file, stopping as soon as we have what we want
+        with z.open(opf_path) as f:
+            for _, el in etree.iterparse(f, tag=[*tags, end_of_metadata]):
+                if el.tag == end_of_metadata:
+                    break
+                tag = tags[el.tag]
+                if tag not in meta and el.text and el.text.strip():
+                    meta[tag] = el.text.strip()
+                el.clear()
+                if len(meta) == len(tags):
+                    break
 
-        # OPF uses namespaces, so define them
-        NS = {
-            "dc": "http://purl.org/dc/elements/1.1/",
-            "opf": "http://www.idpf.org/2007/opf",
-        }
+    return meta
 
-        # Extract the metadata we want
-        for key, tag in [
-            ("title", "title"),
-            ("creator", "author"),
-            ("description", "content"),
-        ]:
-            el = opf.find(f".//dc:{key}", namespaces=NS)
-            if el is not None and el.text:
-                meta[tag] = el.text.strip()
 
-    return meta
+def get_metadata(path):
+    """Get appropriate metadata from the book file at the given filepath, if it has any."""
+    if path.name.lower().endswith(".pdf"):
+        return get_pdf_metadata(path)
+    elif path.name.lower().endswith(".epub"):
+        return get_epub_metadata(path)
+    return dict()
+
+
+def extract_metadata(paths: dict):
+    """Get metadata for each of the given {name: filepath} files, reading them in parallel.
+
+    If a file's result hasn't arrived METADATA_TIMEOUT seconds after we start
+    waiting for it, it's given None instead of metadata.  The worker reading it
+    is killed along with the pool, and any files that hadn't finished yet are
+    read again in a fresh pool.
+    """
+    metas = dict()
+    while len(metas) < len(paths):
+        pending = {name: path for name, path in paths.items() if name not in metas}
+        with multiprocessing.Pool() as pool:
+            results = {
+                name: pool.apply_async(get_metadata, (path,))
+                for name, path in pending.items()
+            }
+            for name, result in results.items():
+                try:
+                    metas[name] = result.get(timeout=METADATA_TIMEOUT)
+                except multiprocessing.TimeoutError:
+                    print("Timed out reading metadata from", name)
+                    metas[name] = None
+                    break
+            # Keep whatever else finished before we gave up
+            for name, result in results.items():
+                if name not in metas and result.ready():
+                    metas[name] = result.get()
+    return metas
+
+
+def load_cache(directory: Path):
+    """Load the metadata cached by a previous run in the given directory, if any."""
+    try:
+        with open(directory / CACHE_FILENAME, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return dict()
+    # Ignore a cache that has been mangled into something else
+    return cache if isinstance(cache, dict) else dict()
+
+
+def save_cache(directory: Path, cache: dict):
+    """Atomically write the metadata cache for the given directory."""
+    cache_path = directory / CACHE_FILENAME
+    tmp_path = cache_path.with_name(CACHE_FILENAME + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, cache_path)
+
+
+@dataclass(slots=True)
+class Book:
+    """Everything we gather about one book while exploring the directory."""
+
+    url: str
+    title: str
+    author: str = "Unknown"
+    content: str = ""
+    updated: int = 0
+    links: list = field(default_factory=list)
+    sources: list = field(default_factory=list)
 
 
 def make_tree(directory: Path, url: str, feed_title: str, feed_author: str):
-    """Look through the given directory and return a dict representing an opds feed for its contents."""
+    """Look through the given directory and return an xml element representing an opds feed for its contents."""
 
     # Normalise url
     url = force_trailing_slash(url)
 
-    # Dictionaries holding information for each book
-    entries = dict()
-    updated = dict()
-    titles = dict()
-    authors = dict()
-    contents = dict()
+    # Add metadata for the whole feed
+    feed = etree.Element(ATOM + "feed", nsmap=NSMAP)
+    feed.append(text_item("title", feed_title))
+    feed.append(text_item("id", url + FEED_FILENAME))
+    feed.append(text_item("updated", timestamp_now()))
+    feed.append(author_item(feed_author))
+    etree.SubElement(
+        feed, ATOM + "link", rel="self", type="application/atom+xml", href=url
+    )
+
+    # Information for each book, by stem
+    books = dict()
+
+    # Metadata extracted on a previous run, and what we find on this one
+    old_cache = load_cache(directory)
+    new_cache = dict()
+
+    # Information for each file we could read book metadata from
+    paths = dict()
+    stats = dict()
+    metas = dict()
 
     # Explore the directory looking for book files
-    for f in sorted(directory.iterdir()):
-        if f.is_file():
-            # Get the attributes for this file type
-            for ending, attributes in FORMATS.items():
-                if f.name.endswith(ending):
-                    # Files apply to the same book if they have the same stem
-                    stem = f.name[: -len(ending)]
-                    break
+    with os.scandir(directory) as it:
+        dir_entries = sorted(it, key=lambda e: e.name)
+    for f in dir_entries:
+        if f.is_file() and f.name != CACHE_FILENAME:
+            # Get the format of this file
+            ending = get_ending(f.name)
 
             # Skip if not a recognised file
             if ending == "":
                 print("Ignored file", f.name)
                 continue
 
+            # Files apply to the same book if they have the same stem
+            stem = f.name[: -len(ending)]
+
             # New book? Add an entry
-            if stem not in entries:
-                entries[stem] = {
-                    NAME: "entry",
-                    CHILDREN: [text_item("id", url + quote(stem))],
-                }
-                updated[stem] = ""
-                titles[stem] = stem
-                authors[stem] = "Unknown"
-                contents[stem] = ""
+            book = books.get(stem)
+            if book is None:
+                book = books[stem] = Book(url=url + quote(stem), title=stem)
 
             # Add this file as a link under the appropriate book
-            entries[stem][CHILDREN].append(
-                {
-                    NAME: "link",
-                    "href": url + quote(f.name),
-                }
-                | attributes
-            )
+            # Endings need no quoting, so only the stem is encoded, once per book
+            href = book.url + f.name[len(stem) :]
+            link = etree.Element(ATOM + "link", LINK_ATTRIBUTES[ending], href=href)
+            link.text = LINK_TEXT.get(ending)
+            book.links.append(link)
 
             # Keep the latest modified time for this book
-            updated[stem] = max(updated[stem], timestamp(f))
-
-            # Extract book metadata from the file if possible
-            if f.name.lower().endswith(".pdf"):
-                meta = get_pdf_metadata(f.resolve())
-            elif f.name.lower().endswith(".epub"):
-                meta = get_epub_metadata(f.resolve())
-            else:
-                meta = dict()
+            st = f.stat()
+            book.updated = max(book.updated, st.st_mtime_ns)
+
+            # Note whether this file could give metadata, reusing last run's if it's unchanged
+            if ending in METADATA_ENDINGS:
+                book.sources.append((METADATA_ENDINGS.index(ending), f.name))
+                paths[f.name] = f.path
+                stats[f.name] = st
+                cached = old_cache.get(f.name)
+                if (
+                    isinstance(cached, dict)
+                    and cached.get("mtime_ns") == st.st_mtime_ns
+                    and cached.get("size") == st.st_size
+                    and isinstance(cached.get("meta"), dict)
+                ):
+                    metas[f.name] = cached["meta"]
+
+    # Read metadata from one file per book, in order of preference, only falling
+    # back to another format if the preferred file has none or timed out
+    candidates = {
+        stem: sorted(book.sources) for stem, book in books.items() if book.sources
+    }
+    while candidates:
+        chosen = {stem: names.pop(0)[1] for stem, names in candidates.items()}
+        pending = {
+            name: Path(paths[name]).resolve()
+            for name in chosen.values()
+            if name not in metas
+        }
+        metas.update(extract_metadata(pending))
+        for stem, name in chosen.items():
+            meta = metas[name] or dict()
+            book = books[stem]
             if "title" in meta:
-                titles[stem] = meta["title"]
+                book.title = meta["title"]
             if "author" in meta:
-                authors[stem] = meta["author"]
+                book.author = meta["author"]
             if "content" in meta:
-                contents[stem] = meta["content"]
-
-    # Put the final metadata into each book entry
-    for stem in updated:
-        entries[stem][CHILDREN].insert(1, text_item("updated", updated[stem]))
-    for stem in titles:
-        entries[stem][CHILDREN].insert(2, text_item("title", titles[stem]))
-    for stem in authors:
-        entries[stem][CHILDREN].insert(
-            3, {NAME: "author", CHILDREN: [text_item("name", authors[stem])]}
-        )
-    for stem in contents:
-        entries[stem][CHILDREN].insert(
-            4,
-            {NAME: "content", "type": "text", CHILDREN: [filter_html(contents[stem])]},
-        )
+                book.content = meta["content"]
+        candidates = {
+            stem: names
+            for stem, names in candidates.items()
+            if names and not metas[chosen[stem]]
+        }
 
-    # Add metadata for the whole feed
-    children = [
-        text_item("title", feed_title),
-        text_item("id", url + FEED_FILENAME),
-        text_item("updated", timestamp_now()),
-        {NAME: "author", CHILDREN: [text_item("name", feed_author)]},
-        {NAME: "link", "rel": "self", "type": "application/atom+xml", "href": url},
-    ] + list(
-        entries.values()
-    )  # add the book entries
-    return {
-        NAME: "feed",
-        NAMESPACE: {
-            None: "http://www.w3.org/2005/Atom",
-            "opds": "http://opds-spec.org/2010/catalog",
-            "dcterms": "http://purl.org/dc/terms/",
-        },
-        CHILDREN: children,
-    }
+    # Remember what we read for next time, leaving out files that timed out
+    for name, meta in metas.items():
+        if meta is None:
+            continue
+        new_cache[name] = {
+            "mtime_ns": stats[name].st_mtime_ns,
+            "size": stats[name].st_size,
+            "meta": meta,
+        }
+    save_cache(directory, new_cache)
+
+    # Add an entry for each book, with its metadata followed by its links
+    for book in books.values():
+        entry = etree.SubElement(feed, ATOM + "entry")
+        entry.append(text_item("id", book.url))
+        entry.append(text_item("updated", timestamp(book.updated)))
+        entry.append(text_item("title", book.title))
+        entry.append(author_item(book.author))
+        entry.append(text_item("content", filter_html(book.content), type="text"))
+        entry.extend(book.links)
 
+    return feed
 
-def generate_xml(tree: dict, outfile: Path):
-    root = dict_to_xml(tree)
+
+def generate_xml(root: etree.Element, outfile: Path):
     tree = etree.ElementTree(root)
 
     # <?xml-stylesheet type="text/xsl" href="style.xsl"?>
@@ -323,8 +486,13 @@ def generate_xml(tree: dict, outfile: Path):
     )
     tree.getroot().addprevious(xslt_line)
 
-    tree.write(str(outfile), encoding="utf-8", xml_declaration=True, pretty_print=True)
+    # Serialise the whole document in memory and write it in one go
+    xml = etree.tostring(
+        tree, encoding="UTF-8", xml_declaration=True, pretty_print=True
+    )
+    Path(outfile).write_bytes(xml)
     print("Wrote file to", outfile)
+    return tree
 
 
 def copy_file(source, target):
@@ -336,18 +504,19 @@ def copy_file(source, target):
         print("Wrote file to", target)
 
 
-def test_xsl(directory: str):
-    # Find files
-    feed_path = directory + FEED_FILENAME
-    xsl_path = directory + STYLE_FILENAME
+@lru_cache(maxsize=4)
+def get_transform(xsl_path: str, mtime: float):
+    """Parse and compile the xsl stylesheet at the given path, reusing it while unchanged."""
+    return etree.XSLT(etree.parse(xsl_path))
 
-    # Parse files
-    xml = etree.parse(feed_path)
-    xsl = etree.parse(STYLE_FILENAME)
 
-    # Construct html form
-    transform = etree.XSLT(xsl)
-    result = transform(xml)
+def test_xsl(tree: etree.ElementTree, directory: str):
+    # Find style file
+    xsl_path = directory + STYLE_FILENAME
+
+    # Construct html form from the feed we already have in memory
+    transform = get_transform(xsl_path, os.path.getmtime(xsl_path))
+    result = transform(tree)
     return str(result)
 
 
@@ -392,15 +561,15 @@ def main():
     feed_path = directory_path + FEED_FILENAME
 
     # Create feed file
-    tree_dict = make_tree(Path(directory_path), directory_url, feed_title, feed_author)
-    generate_xml(tree_dict, feed_path)
+    feed = make_tree(Path(directory_path), directory_url, feed_title, feed_author)
+    tree = generate_xml(feed, feed_path)
 
     # Copy xsl style file
     style_file = resources.files("quickopds").joinpath(STYLE_FILENAME)
     copy_file(style_file, directory_path + STYLE_FILENAME)
 
     # Test xsl transformation
-    html = test_xsl(directory_path)
+    html = test_xsl(tree, directory_path)
     print(f"xsl transform succeeded with {len(html)} characters")
 
 if __name__ == "__main__":